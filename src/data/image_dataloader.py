@@ -2,19 +2,35 @@
 with(out) transformations.
 """
 
+import contextlib
+import functools
+import io
+import logging
+import os
 import random
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 import albumentations as A
 import cv2
+import kornia.augmentation as K
 import numpy as np
 import pandas as pd
 import torch
-import torchvision.transforms as T
-from torch.utils.data import DataLoader, Dataset, Subset
+from PIL import Image
+from torch.utils.data import (BatchSampler, DataLoader, Dataset, Subset,
+                              SubsetRandomSampler)
 from torchvision.ops import box_convert
 
 from src.utils import collate_batch, stratified_group_train_test_split
 
+try:
+    # Decode JPEG images directly to RGB with libjpeg-turbo if it is available
+    from turbojpeg import TJPF_RGB, TurboJPEG
+    JPEG_DECODER = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    JPEG_DECODER = None
+
 # Set partial reproducibility
 SEED = 0
 random.seed(SEED)
@@ -22,9 +38,91 @@ np.random.seed(SEED)
 torch.manual_seed(SEED)
 torch.cuda.manual_seed_all(SEED)
 
+BBOX_COLUMNS = ['bbox_x', 'bbox_y', 'bbox_width', 'bbox_height']
 BBOX_FORMATS = {'coco': 'xywh',
                 'pascal_voc': 'xyxy',
                 'yolo': 'cxcywh'}
+EXIF_ORIENTATION_TAG = 0x0112
+
+
+def seed_worker(worker_id):
+    """Re-seed NumPy and random in a DataLoader worker process to keep
+    image augmentation reproducible when multi-process data loading is used.
+    """
+    worker_seed = torch.initial_seed() % 2**32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+
+class SmartResize(A.DualTransform):
+    """Rescale an image with one interpolation so that its smallest side is equal
+    to min_size unless its largest side then exceeds max_size, in which case
+    the largest side is equal to max_size (as with the resizing performed
+    by Faster R-CNN models).
+    """
+
+    def __init__(self, min_size=800, max_size=1333, interpolation=cv2.INTER_LINEAR,
+                 always_apply=False, p=1):
+        super().__init__(always_apply, p)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.interpolation = interpolation
+
+    def apply(self, img, interpolation=cv2.INTER_LINEAR, **params):  # noqa: D102
+        height, width = img.shape[:2]
+        scale = min(self.min_size / min(height, width), self.max_size / max(height, width))
+        new_size = (round(width * scale), round(height * scale))
+        return cv2.resize(img, new_size, interpolation=interpolation)
+
+    def apply_to_bbox(self, bbox, **params):  # noqa: D102
+        # Bounding box coordinates are normalized in the albumentations format
+        return bbox
+
+    def get_params(self):  # noqa: D102
+        return {'interpolation': self.interpolation}
+
+    def get_transform_init_args_names(self):  # noqa: D102
+        return ('min_size', 'max_size', 'interpolation')
+
+
+def create_bbox_index(bbox_df):
+    """Return a dictionary of image names and arrays of their bounding boxes."""
+    return {name: img_bboxes[BBOX_COLUMNS].to_numpy(dtype=np.float32)
+            for name, img_bboxes in bbox_df.groupby('image_name', sort=False)}
+
+
+def get_exif_orientation(img_bytes):
+    """Return the EXIF orientation of an encoded image (1 if it is not set)."""
+    return Image.open(io.BytesIO(img_bytes)).getexif().get(EXIF_ORIENTATION_TAG, 1)
+
+
+def save_image_array(image, save_path):
+    """Save an image array to a .npy file, writing it to a temporary file first
+    so that a partially written file is never read.
+    """
+    tmp_path = get_tmp_image_array_path(save_path)
+    with open(tmp_path, 'wb') as f:
+        np.save(f, image)
+    os.replace(tmp_path, save_path)
+
+
+def get_tmp_image_array_path(save_path):
+    """Return a path to a temporary file of the current process for saving
+    an image array (see save_image_array).
+    """
+    return f'{save_path}.{os.getpid()}.tmp'
+
+
+def log_failed_image_array_save(save_path, future):
+    """Log an exception raised while saving an image array in the background
+    (see save_image_array) and remove the temporary file left by it.
+    """
+    if future.cancelled() or future.exception() is None:
+        return
+    logging.warning("The decoded image is not cached to {}: {}".format(save_path,
+                                                                       future.exception()))
+    with contextlib.suppress(OSError):
+        os.remove(get_tmp_image_array_path(save_path))
 
 
 def get_image_transforms(box_format):
@@ -35,53 +133,135 @@ def get_image_transforms(box_format):
     https://albumentations.ai/docs/getting_started/setting_probabilities/
     for more information on how calculated actual probability of other transformations
     and containers in the augmentation pipeline.
+
+    Applied transformations are saved in the result ('replay') so that they
+    can be applied to other images with the same parameters.
+    """
+    aug = A.ReplayCompose([
+                          SmartResize(800, 1333, always_apply=True),
+                          A.HorizontalFlip(p=0.6),
+                          A.VerticalFlip(p=0.4),
+                          ],
+                          A.BboxParams(format=box_format, label_fields=['labels']),
+                          p=0.8)
+    return aug
+
+
+def get_device_image_transforms():
+    """Return the transform function that will perform photometric image augmentation
+    of float image tensors (N, C, H, W) on the device where they are located.
+
+    These transformations do not change bounding boxes, so they are applied
+    to images in a training loop instead of DataLoader worker processes.
     """
-    aug = A.Compose([
-                    A.SmallestMaxSize(800, always_apply=True),
-                    A.LongestMaxSize(1333, always_apply=True),
-                    A.HorizontalFlip(p=0.6),
-                    A.VerticalFlip(p=0.4),
-                    A.ColorJitter(0.5, 0.5, 0.5, 0, p=0.7),
-                    A.RandomRain(p=0.5),
-                    A.OneOrOther(
-                        A.Blur(10, p=0.7),
-                        A.GaussianBlur((11, 21), p=0.3),
-                        p=0.6),
-                    ],
-                    A.BboxParams(format=box_format, label_fields=['labels']),
-                    p=0.8)
+    aug = K.AugmentationSequential(
+        K.ColorJitter(0.5, 0.5, 0.5, 0, p=0.7),
+        K.RandomGaussianBlur((11, 11), (0.1, 2.0), p=0.6),
+        same_on_batch=False)
     return aug
 
 
 class ImageBBoxDataset(Dataset):
-    """A Dataset for object detection tasks."""
+    """A Dataset for object detection tasks.
+
+    Images are returned as uint8 tensors of shape (C, H, W). If cache_dir is set,
+    decoded images are saved there in the background as .npy files and memory-mapped
+    instead of being decoded again when they are next read (while the size
+    and modification time of their source files are unchanged).
+
+    Already loaded image information (img_df) and a bounding box index created
+    by create_bbox_index (bbox_index) can be passed instead of reading
+    the corresponding CSV files, e.g. to share them between several datasets.
+    """
 
     def __init__(self, csv_file_path, img_dir_path, bbox_path,
-                 img_transforms=None, bbox_transform=None):
+                 img_transforms=None, bbox_transform=None, cache_dir=None,
+                 img_df=None, bbox_index=None):
         self.img_dir_path = img_dir_path
-        self.img_df = pd.read_csv(csv_file_path)
-        self.bbox_df = pd.read_csv(bbox_path)
+        if img_df is None:
+            img_df = pd.read_csv(csv_file_path)
+        # Keep only image names and paths (as strings to avoid converting Path objects
+        # for every image read) instead of the whole image information
+        self.img_names = img_df.iloc[:, 0].to_numpy()
+        self.img_paths = [os.fspath(self.img_dir_path / name) for name in self.img_names]
+        # Index boxes by image name once to avoid scanning all boxes for each image
+        self.bbox_index = (create_bbox_index(pd.read_csv(bbox_path))
+                           if bbox_index is None else bbox_index)
         self.img_transforms = img_transforms
         self.bbox_transform = bbox_transform  # (bbox_transform_fn, *bbox_transform_args)
+        self.cache_paths = None
+        self.cache_executor = None
+        self.cache_executor_pid = None
+
+        if cache_dir is not None:
+            cache_dir = Path(cache_dir)
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            # Key cached arrays by the size and modification time of source images
+            # so that images overwritten under the same name are decoded again
+            self.cache_paths = []
+            for name, img_path in zip(self.img_names, self.img_paths):
+                img_stat = os.stat(img_path)
+                self.cache_paths.append(os.fspath(
+                    cache_dir / f'{name}.{img_stat.st_size}.{img_stat.st_mtime_ns}.npy'))
+
+    def __getstate__(self):
+        # Thread pools cannot be shared with DataLoader worker processes
+        state = self.__dict__.copy()
+        state['cache_executor'] = None
+        return state
 
     def __len__(self):
-        return self.img_df.shape[0]
+        return len(self.img_names)
 
-    def __getitem__(self, idx):
-        img_name = self.img_df.iloc[idx, 0]
-        img_path = self.img_dir_path / img_name
-        image = cv2.cvtColor(cv2.imread(str(img_path)), cv2.COLOR_BGR2RGB)
-        bboxes = self.bbox_df.loc[(self.bbox_df.image_name == img_name),
-                                  ['bbox_x', 'bbox_y', 'bbox_width', 'bbox_height']].values
-        labels = torch.ones((bboxes.shape[0],), dtype=torch.int64)
+    def get_cache_executor(self):
+        """Return a thread pool of the current process to save decoded images."""
+        if self.cache_executor is None or self.cache_executor_pid != os.getpid():
+            self.cache_executor = ThreadPoolExecutor(max_workers=1)
+            self.cache_executor_pid = os.getpid()
+        return self.cache_executor
 
-        if self.img_transforms:
-            aug = self.img_transforms(image=image, bboxes=bboxes, labels=labels)
-            image = aug['image']
-            bboxes = aug['bboxes']
+    def read_image(self, idx):
+        """Return an RGB image from the cache directory if it is cached,
+        otherwise decode it from the image directory (and cache it if necessary).
+        """
+        if self.cache_paths is not None:
+            cache_path = self.cache_paths[idx]
+            if os.path.exists(cache_path):
+                return np.load(cache_path, mmap_mode='r').copy()
 
-        image = T.ToTensor()(image)
-        bboxes = torch.as_tensor(bboxes, dtype=torch.float)
+        img_path = self.img_paths[idx]
+        image = None
+        if JPEG_DECODER is not None and img_path.lower().endswith(('.jpg', '.jpeg')):
+            with open(img_path, 'rb') as f:
+                img_bytes = f.read()
+            # libjpeg-turbo ignores the EXIF orientation, so rotated or flipped images
+            # are decoded with OpenCV to keep them consistent with their bounding boxes
+            if get_exif_orientation(img_bytes) == 1:
+                image = JPEG_DECODER.decode(img_bytes, pixel_format=TJPF_RGB)
+        if image is None:
+            image = cv2.imread(img_path, cv2.IMREAD_COLOR)
+            cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
+
+        if self.cache_paths is not None:
+            future = self.get_cache_executor().submit(save_image_array, image, cache_path)
+            future.add_done_callback(functools.partial(log_failed_image_array_save,
+                                                       cache_path))
+        return image
+
+    def load_image_bboxes_labels(self, idx):
+        """Return an image with its bounding boxes and labels before transformations."""
+        image = self.read_image(idx)
+        bboxes = self.bbox_index.get(self.img_names[idx], np.zeros((0, 4), dtype=np.float32))
+        labels = torch.ones((bboxes.shape[0],), dtype=torch.int64)
+        return image, bboxes, labels
+
+    def create_image_target(self, image, bboxes, labels):
+        """Return an image tensor and a target dictionary with box and label tensors."""
+        # Keep uint8 values (HWC -> CHW) to be converted to float on a target device
+        image = torch.from_numpy(np.ascontiguousarray(image.transpose(2, 0, 1)))
+        # Copy boxes (a list after transformations) to a new array so that a tensor
+        # does not share memory with the bounding box index
+        bboxes = torch.from_numpy(np.array(bboxes, dtype=np.float32).reshape(-1, 4))
 
         if self.bbox_transform:
             bboxes = self.bbox_transform[0](bboxes, *self.bbox_transform[1:])
@@ -91,13 +271,63 @@ class ImageBBoxDataset(Dataset):
 
         return image, target
 
+    def __getitem__(self, idx):
+        image, bboxes, labels = self.load_image_bboxes_labels(idx)
+
+        if self.img_transforms:
+            aug = self.img_transforms(image=image, bboxes=bboxes, labels=labels)
+            image = aug['image']
+            bboxes = aug['bboxes']
+
+        return self.create_image_target(image, bboxes, labels)
+
+
+class BatchedImageBBoxDataset(ImageBBoxDataset):
+    """A Dataset for object detection tasks that returns a list of samples
+    for a list of indices (e.g. from a BatchSampler).
+
+    Image transformations (albumentations.ReplayCompose) are applied to all
+    images in the list with the same parameters, which are randomly selected
+    only once for the first image.
+    """
+
+    def __getitem__(self, ids):
+        samples = []
+        replay = None
+
+        for idx in ids:
+            image, bboxes, labels = self.load_image_bboxes_labels(idx)
+
+            if self.img_transforms:
+                if replay is None:
+                    aug = self.img_transforms(image=image, bboxes=bboxes, labels=labels)
+                    replay = aug['replay']
+                else:
+                    aug = A.ReplayCompose.replay(replay, image=image, bboxes=bboxes,
+                                                 labels=labels)
+                image = aug['image']
+                bboxes = aug['bboxes']
+
+            samples.append(self.create_image_target(image, bboxes, labels))
+
+        return samples
+
 
 def create_dataloaders(img_dir_path, csv_file_path, bboxes_path, batch_size,
                        box_format_before_transform='coco', train_test_split_data=False,
-                       transform_train_imgs=False):
+                       transform_train_imgs=False, num_workers=0, pin_memory=False,
+                       persistent_workers=False, prefetch_factor=2, cache_dir=None,
+                       same_transforms_per_batch=False):
     """Return one DataLoader object (or two if train_test_split_data=True) with applying
     a box transformation to pascal_voc ('xyxy') format and training image
     transformations if necessary.
+
+    If same_transforms_per_batch=True, training image transformations are applied
+    to all images in a batch with the same parameters.
+
+    Images are loaded in num_workers subprocesses (limited by the number of CPUs)
+    if num_workers > 0, otherwise in the main process. Pinned memory is used only
+    if CUDA is available. Decoded images are cached in cache_dir if it is set.
     """
     # Set ImageBBoxDataset parameters
     img_transforms = (get_image_transforms(box_format_before_transform)
@@ -110,26 +340,52 @@ def create_dataloaders(img_dir_path, csv_file_path, bboxes_path, batch_size,
 
     dataset_params = {'img_dir_path': img_dir_path,
                       'bbox_path': bboxes_path,
-                      'bbox_transform': bbox_transform}
+                      'bbox_transform': bbox_transform,
+                      'cache_dir': cache_dir}
 
+    num_workers = min(num_workers, os.cpu_count() or 1)
     dl_params = {'batch_size': batch_size,
-                 'collate_fn': collate_batch}
+                 'collate_fn': collate_batch,
+                 'num_workers': num_workers,
+                 'pin_memory': pin_memory and torch.cuda.is_available(),
+                 'worker_init_fn': seed_worker}
+
+    if num_workers > 0:
+        # Set parameters that are only valid for multi-process data loading
+        dl_params.update({'persistent_workers': persistent_workers,
+                          'prefetch_factor': prefetch_factor})
 
     if train_test_split_data:
-        # Create ImageBBoxDataset objects
+        # Create ImageBBoxDataset objects sharing the loaded data
+        img_df = pd.read_csv(csv_file_path)
+        bbox_index = create_bbox_index(pd.read_csv(bboxes_path))
+        batch_train_transforms = same_transforms_per_batch and img_transforms is not None
+        train_dataset_class = (BatchedImageBBoxDataset if batch_train_transforms
+                               else ImageBBoxDataset)
         train_dataset, val_dataset = [
-            ImageBBoxDataset(csv_file_path,
-                             img_transforms=img_tr,
-                             **dataset_params) for img_tr in [img_transforms, None]]
+            ds_class(csv_file_path,
+                     img_transforms=img_tr,
+                     img_df=img_df,
+                     bbox_index=bbox_index,
+                     **dataset_params) for ds_class, img_tr in [
+                         (train_dataset_class, img_transforms), (ImageBBoxDataset, None)]]
 
         # Split data into training and validation sets
-        train_ids, val_ids = stratified_group_train_test_split(train_dataset.img_df['Name'],
-                                                               train_dataset.img_df['Number_HSparrows'],
-                                                               train_dataset.img_df['Author'],
+        train_ids, val_ids = stratified_group_train_test_split(img_df['Name'].to_numpy(),
+                                                               img_df['Number_HSparrows'].to_numpy(),
+                                                               img_df['Author'].to_numpy(),
                                                                SEED)
         # Create DataLoader objects
-        train_dataloader = DataLoader(Subset(train_dataset, train_ids), shuffle=True,
-                                      **dl_params)
+        if batch_train_transforms:
+            # Pass batches of shuffled training indices to the dataset
+            # (automatic batching is disabled with batch_size=None)
+            train_sampler = BatchSampler(SubsetRandomSampler(train_ids), batch_size,
+                                         drop_last=False)
+            train_dataloader = DataLoader(train_dataset, sampler=train_sampler,
+                                          **{**dl_params, 'batch_size': None})
+        else:
+            train_dataloader = DataLoader(Subset(train_dataset, train_ids), shuffle=True,
+                                          **dl_params)
         val_dataloader = DataLoader(Subset(val_dataset, val_ids), **dl_params)
         return train_dataloader, val_dataloader
     else:
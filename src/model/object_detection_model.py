@@ -2,14 +2,22 @@
 (MobileNet) model.
 """
 
+import logging
+
+import torch
 from torchvision.models.detection import fasterrcnn_mobilenet_v3_large_fpn
 from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
 
 
-def faster_rcnn_mob_model_for_n_classes(num_classes, print_head=False, **load_model_params):
+def faster_rcnn_mob_model_for_n_classes(num_classes, print_head=False, compile_model=False,
+                                        **load_model_params):
     """Load the pre-trained Faster R-CNN (MobileNet Large) model
     and modify it to classify N classes (true classes + the background).
 
+    If compile_model is True and the installed PyTorch version supports it,
+    the model is compiled in place with torch.compile (dynamic shapes are used
+    since input image sizes vary).
+
     More information about the model and its parameters can be found
     at the following link:
     https://github.com/pytorch/vision/blob/main/torchvision/models/detection/faster_rcnn.py
@@ -29,4 +37,12 @@ def faster_rcnn_mob_model_for_n_classes(num_classes, print_head=False, **load_mo
     if print_head:
         print("The Model's Head - After: \n", faster_rcnn_mob.roi_heads.box_predictor)
 
+    if compile_model:
+        # In-place compilation keeps state dictionary keys of the original model
+        if hasattr(torch.nn.Module, 'compile'):
+            faster_rcnn_mob.compile(mode='reduce-overhead', dynamic=True)
+        else:
+            logging.warning("Model is not compiled: PyTorch {} does not support "
+                            "in-place compilation.".format(torch.__version__))
+
     return faster_rcnn_mob
@@ -24,12 +24,12 @@ def update_registered_model_version_stages(mlclient, registered_model_name):
     model_registry_info = mlclient.get_latest_versions(registered_model_name)
     model_latest_version = max([m.version for m in model_registry_info])
 
-    # Update model version stages
+    # Update model version stages, keeping the returned updated model versions
+    # instead of requesting them from the registry again
+    updated_model_registry_info = []
     for m in model_registry_info:
         if m.version == model_latest_version:
-            if m.current_stage == 'Production':
-                continue
-            else:
+            if m.current_stage != 'Production':
                 m = mlclient.transition_model_version_stage(name=registered_model_name,
                                                             version=m.version,
                                                             stage='Production')
@@ -38,11 +38,12 @@ def update_registered_model_version_stages(mlclient, registered_model_name):
                 m = mlclient.transition_model_version_stage(name=registered_model_name,
                                                             version=m.version,
                                                             stage='Archived')
+        updated_model_registry_info.append(m)
 
     # View updated model version stages
     prod_run_id = 0
     prod_model_id = 0
-    for m in mlclient.get_latest_versions(registered_model_name):
+    for m in updated_model_registry_info:
         logging.info("Updated model version stages: ")
         logging.info(f"{m.name}: version: {m.version}, current stage: {m.current_stage}")
 
@@ -1,6 +1,5 @@
 """This module implements fine-tuning of object detection model."""
 
-import gc
 import logging
 import os
 import random
@@ -11,11 +10,13 @@ import numpy as np
 import torch
 import torchvision
 
-from src.data.image_dataloader import create_dataloaders
+from src.data.image_dataloader import create_dataloaders, get_device_image_transforms
 from src.model.object_detection_model import faster_rcnn_mob_model_for_n_classes
-from src.train.train_inference_fns import eval_one_epoch, train_one_epoch
+from src.train.train_inference_fns import (build_lr_scheduler, build_optimizer,
+                                           eval_one_epoch, free_up_memory,
+                                           train_one_epoch)
 from src.utils import (draw_bboxes_on_image, get_device, get_param_config_yaml,
-                       save_model_state)
+                       load_model_state, save_model_state)
 
 logging.basicConfig(level=logging.INFO, filename='pipe.log',
                     format="%(asctime)s -- [%(levelname)s]: %(message)s")
@@ -34,7 +35,8 @@ def run_train(train_dataloader, val_dataloader, model, epochs, optimizer_name,
               metric_to_find_best_model=None, init_metric_value=0.0,
               eval_iou_thresh=0.5, eval_beta=1, model_name='best_model', save_best_ckpt=False,
               checkpoint=None, log_metrics=False, register_best_log_model=False,
-              reg_model_name='best_model', save_random_best_model_output_path=None):
+              reg_model_name='best_model', save_random_best_model_output_path=None,
+              train_img_transforms=None, low_memory=False):
     """Run a new model training and evaluation cycle for the fixed number of epochs
     or continue if a checkpoint is set, while saving the best model weights
     (or a checkpoint).
@@ -86,6 +88,12 @@ def run_train(train_dataloader, val_dataloader, model, epochs, optimizer_name,
     save_random_best_model_output_path: Path, optional
         Path to a directory to save a random image with
         the best model prediction boxes and scores drawn on it (default None).
+    train_img_transforms: callable, optional
+        Image transformations applied to training images on the device
+        (default None).
+    low_memory: bool
+        Whether to free up memory after each batch and epoch at the cost of speed
+        (default False).
 
     Return
     ------
@@ -94,36 +102,40 @@ def run_train(train_dataloader, val_dataloader, model, epochs, optimizer_name,
     logging.info(f"Device: {device}")
     start_epoch = 0
     best_epoch_score = init_metric_value
-    lr_scheduler = None
 
-    model_params = [p for p in model.parameters() if p.requires_grad]
-    # Construct an optimizer
-    optimizer = getattr(torch.optim, optimizer_name)(model_params, **optimizer_parameters)
+    # Use automatic mixed precision on CUDA devices
+    scaler = torch.cuda.amp.GradScaler(enabled=device.type == 'cuda')
 
-    if lr_scheduler_name is not None:
-        if lr_scheduler_parameters is None:
-            lr_scheduler_parameters = {}
-        # Construct a learning rate scheduler
-        lr_scheduler = getattr(torch.optim.lr_scheduler, lr_scheduler_name)(optimizer,
-                                                                            **lr_scheduler_parameters)
+    # Construct an optimizer and a learning rate scheduler (if necessary)
+    optimizer = build_optimizer(model, optimizer_name, optimizer_parameters)
+    lr_scheduler = build_lr_scheduler(optimizer, lr_scheduler_name, lr_scheduler_parameters)
 
     if checkpoint is not None:
         # Get state parameters from the checkpoint
         model.load_state_dict(checkpoint['model_state_dict'])
         optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        if 'scaler_state_dict' in checkpoint:
+            scaler.load_state_dict(checkpoint['scaler_state_dict'])
         start_epoch = checkpoint['epoch']
         best_epoch_score = (checkpoint[metric_to_find_best_model + '_score']
                             if metric_to_find_best_model else 0.0)
 
     model.to(device)
 
+    if device.type == 'cuda':
+        # Let cuDNN find the fastest convolution algorithms and use channels-last (NHWC)
+        # convolution weights, which makes convolutions run in NHWC kernels
+        torch.backends.cudnn.benchmark = True
+        model.to(memory_format=torch.channels_last)
+
     for epoch in range(1, epochs + 1):
         current_epoch = start_epoch + epoch
         logging.info(f"EPOCH [{current_epoch}/{start_epoch + epochs}]: ")
 
         # Training step
         logging.info("TRAIN:")
-        train_res = train_one_epoch(train_dataloader, model, optimizer, device)
+        train_res = train_one_epoch(train_dataloader, model, optimizer, device,
+                                    train_img_transforms, scaler, low_memory)
         logging.info("  epoch loss: {0}:\n    {1}".format(train_res['epoch_loss'],
                                                           train_res['epoch_dict_losses']))
 
@@ -132,7 +144,8 @@ def run_train(train_dataloader, val_dataloader, model, epochs, optimizer_name,
 
         # Evaluation step
         logging.info("EVAL:")
-        eval_res = eval_one_epoch(val_dataloader, model, eval_iou_thresh, eval_beta, device)
+        eval_res = eval_one_epoch(val_dataloader, model, eval_iou_thresh, eval_beta, device,
+                                  low_memory)
         logging.info("\n  epoch scores: {}".format(eval_res['epoch_scores']))
 
         if metric_to_find_best_model:
@@ -152,6 +165,7 @@ def run_train(train_dataloader, val_dataloader, model, epochs, optimizer_name,
                 if save_best_ckpt:
                     ckpt_dict = {'epoch': current_epoch,
                                  'optimizer_state_dict': optimizer.state_dict(),
+                                 'scaler_state_dict': scaler.state_dict(),
                                  metric_to_find_best_model + '_score': best_epoch_score}
                     filename += '_ckpt'
 
@@ -175,20 +189,21 @@ def run_train(train_dataloader, val_dataloader, model, epochs, optimizer_name,
                         del preds
 
             if log_metrics:
-                # Log losses and scores into MLflow
-                mlflow.log_metric('train_epoch_loss', train_res['epoch_loss'],
-                                  step=current_epoch)
-                mlflow.log_metrics(train_res['epoch_dict_losses'], step=current_epoch)
-                mlflow.log_metrics(eval_res['epoch_scores'], step=current_epoch)
+                # Log losses and scores into MLflow in one call
+                # (loss and score names do not overlap)
+                mlflow.log_metrics({'train_epoch_loss': train_res['epoch_loss'],
+                                    **train_res['epoch_dict_losses'],
+                                    **eval_res['epoch_scores']}, step=current_epoch)
                 logging.info("Metrics are logged.")
 
-        # Free up memory
-        gc.collect()
-        if str(device) == 'cuda':
-            torch.cuda.empty_cache()
+        if low_memory:
+            free_up_memory(device)
 
         logging.info("-" * 60)
 
+    # Free up memory
+    free_up_memory(device)
+
     logging.info("DONE!")
     return {'train_res': train_res,
             'eval_res': eval_res}
@@ -206,8 +221,15 @@ def main(project_path, param_config):
                                            img_data_paths['train_csv_file'],
                                            img_data_paths['bboxes_csv_file']]]
     batch_size = param_config['image_dataset_conf']['batch_size']
+    dl_params = param_config['image_dataset_conf']['dataloader_parameters']
+    cache_dir = param_config['image_dataset_conf']['decoded_image_cache_dir']
+    img_cache_path = project_path / cache_dir if cache_dir else None
+    same_transforms_per_batch = param_config['image_dataset_conf']['same_transforms_per_batch']
     train_dl, val_dl = create_dataloaders(imgs_path, train_csv_path, bbox_csv_path, batch_size,
-                                          train_test_split_data=True, transform_train_imgs=True)
+                                          train_test_split_data=True, transform_train_imgs=True,
+                                          cache_dir=img_cache_path,
+                                          same_transforms_per_batch=same_transforms_per_batch,
+                                          **dl_params)
 
     # Load a modified model
     model_params = param_config['object_detection_model']['load_parameters']
@@ -238,7 +260,7 @@ def main(project_path, param_config):
     save_dir = param_config['object_detection_model']['save_dir']
     if TRAIN_EVAL_PARAMS['checkpoint']:
         checkpoint_path = project_path / save_dir / TRAIN_EVAL_PARAMS['checkpoint']
-        checkpoint = torch.load(checkpoint_path) if checkpoint_path.exists() else None
+        checkpoint = load_model_state(checkpoint_path) if checkpoint_path.exists() else None
 
     # Set paths to save the best model weights and outputs
     save_best_model_weights_path = project_path / save_dir if save_dir else None
@@ -275,6 +297,7 @@ def main(project_path, param_config):
                       register_best_log_model=TRAIN_EVAL_PARAMS['register_best_log_model'],
                       reg_model_name=param_config['object_detection_model']['registered_name'],
                       save_random_best_model_output_path=save_output_path,
+                      train_img_transforms=get_device_image_transforms(),
                       checkpoint=checkpoint, **train_params, **add_train_params)
 
         # Log the parameters into MLflow
@@ -50,7 +50,12 @@ def main(project_path, param_config, get_random_prediction_image=False,
                                            IMG_DATA_PATHS['test_csv_file'],
                                            IMG_DATA_PATHS['bboxes_csv_file']]]
     batch_size = param_config['image_dataset_conf']['batch_size']
-    test_dl = create_dataloaders(imgs_path, test_csv_path, bbox_csv_path, batch_size)
+    dl_params = param_config['image_dataset_conf']['dataloader_parameters']
+    cache_dir = param_config['image_dataset_conf']['decoded_image_cache_dir']
+    img_cache_path = project_path / cache_dir if cache_dir else None
+    test_dl = create_dataloaders(imgs_path, test_csv_path, bbox_csv_path, batch_size,
+                                 cache_dir=img_cache_path,
+                                 **dl_params)
     test_eval_params = {'dataloader': test_dl,
                         'iou_thresh': TRAIN_EVAL_PARAMS['evaluation_iou_threshold'],
                         'beta': TRAIN_EVAL_PARAMS['evaluation_beta'],
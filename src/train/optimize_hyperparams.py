@@ -11,7 +11,8 @@ import yaml
 
 from src.data.image_dataloader import create_dataloaders
 from src.model.object_detection_model import faster_rcnn_mob_model_for_n_classes
-from src.train.train_inference_fns import eval_one_epoch, train_one_epoch
+from src.train.train_inference_fns import (build_lr_scheduler, build_optimizer,
+                                           eval_one_epoch, train_one_epoch)
 from src.utils import get_device, get_param_config_yaml
 
 logging.basicConfig(level=logging.INFO, filename='pipe.log',
@@ -48,12 +49,10 @@ class Objective:
         hyperparams = self.hyper_opt_params_conf['hyperparameters']
 
         # Construct a training optimizer and a lr_scheduler
-        train_model_params = [p for p in self.model.parameters() if p.requires_grad]
         optimizer_name = trial.suggest_categorical('optimizer', list(hyperparams['optimizers']))
         optim_params = {k: trials_suggest[v[1]](k, **v[0])
                         for k, v in hyperparams['optimizers'][optimizer_name].items()}
-        train_model_params = [p for p in self.model.parameters() if p.requires_grad]
-        optimizer = getattr(torch.optim, optimizer_name)(train_model_params, **optim_params)
+        optimizer = build_optimizer(self.model, optimizer_name, optim_params)
 
         lr_scheduler_name = trial.suggest_categorical('lr_scheduler',
                                                       list(hyperparams['lr_schedulers']))
@@ -62,14 +61,15 @@ class Objective:
             lr_scheduler_params = {
                 k: trials_suggest[v[1]](k, **v[0])
                 for k, v in lrs.items()} if lrs else {}
-            lr_scheduler = getattr(
-                torch.optim.lr_scheduler, lr_scheduler_name)(optimizer, **lr_scheduler_params)
+            lr_scheduler = build_lr_scheduler(optimizer, lr_scheduler_name, lr_scheduler_params)
         else:
             lr_scheduler = None
 
-        # Train a model
+        # Train a model (with automatic mixed precision on CUDA devices)
+        scaler = torch.cuda.amp.GradScaler(enabled=self.device.type == 'cuda')
         for epoch in range(1, self.hyper_opt_params_conf['epochs'] + 1):
-            _ = train_one_epoch(self.train_dl, self.model, optimizer, self.device)
+            _ = train_one_epoch(self.train_dl, self.model, optimizer, self.device,
+                                scaler=scaler)
 
             if lr_scheduler is not None:
                 lr_scheduler.step()
@@ -131,6 +131,9 @@ def main(project_path, param_config):
     # Get configurations for hyperparameter optimization
     img_data_paths = param_config['image_data_paths']
     batch_size = param_config['image_dataset_conf']['batch_size']
+    dl_params = param_config['image_dataset_conf']['dataloader_parameters']
+    cache_dir = param_config['image_dataset_conf']['decoded_image_cache_dir']
+    img_cache_path = project_path / cache_dir if cache_dir else None
     model_params = param_config['object_detection_model']['load_parameters']
     num_classes = param_config['object_detection_model']['number_classes']
     eval_iou_thresh = param_config['model_training_inference_conf']['evaluation_iou_threshold']
@@ -149,7 +152,9 @@ def main(project_path, param_config):
                                            img_data_paths['train_csv_file'],
                                            img_data_paths['bboxes_csv_file']]]
     train_dl, val_dl = create_dataloaders(imgs_path, train_csv_path, bbox_csv_path,
-                                          batch_size, train_test_split_data=True)
+                                          batch_size, train_test_split_data=True,
+                                          cache_dir=img_cache_path,
+                                          **dl_params)
 
     # Load a model
     frcnn_mob_model = faster_rcnn_mob_model_for_n_classes(num_classes, **model_params)
@@ -1,6 +1,10 @@
-"""This module contains metrics and functions for a model training-evaluation cycle."""
+"""This module contains metrics, a data prefetcher, and functions for a model
+training-evaluation cycle.
+"""
 
+import contextlib
 import gc
+import weakref
 
 import torch
 import torchvision.transforms as T
@@ -8,6 +12,9 @@ from torchvision.ops import box_iou
 
 from src.utils import draw_bboxes_on_image
 
+# Lists of trainable parameters of models (see get_trainable_parameters)
+TRAINABLE_MODEL_PARAMETERS = weakref.WeakKeyDictionary()
+
 
 @torch.inference_mode()
 def object_detection_precision_recall_fbeta_scores(gts, preds, iou_thresh=0.5, beta=1):
@@ -90,8 +97,126 @@ def object_detection_precision_recall_fbeta_scores(gts, preds, iou_thresh=0.5, b
             'f_beta': f_beta}
 
 
-def train_one_epoch(dataloader, model, optimizer, device=torch.device('cpu')):  # noqa: B008
-    """Pass a training step in one epoch."""
+class CUDAPrefetcher:
+    """A DataLoader wrapper that iterates over batches of images and targets
+    moved to a device.
+
+    On a CUDA device, the next batch is copied in a separate CUDA stream
+    while the current one is being processed (copies are asynchronous
+    if the DataLoader uses pinned memory).
+    """
+
+    def __init__(self, dataloader, device=torch.device('cpu')):  # noqa: B008
+        self.dataloader = dataloader
+        self.device = device
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        self.loader_iter = None
+        self.batch = None
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        self.loader_iter = iter(self.dataloader)
+        self.preload()
+        batch = self.next()
+        while batch is not None:
+            yield batch
+            batch = self.next()
+
+    def preload(self):
+        """Start moving the next batch to the device."""
+        try:
+            images, targets = next(self.loader_iter)
+        except StopIteration:
+            self.batch = None
+            return
+
+        stream_context = (torch.cuda.stream(self.stream) if self.stream is not None
+                          else contextlib.nullcontext())
+        with stream_context:
+            images = [img.to(self.device, non_blocking=True) for img in images]
+            targets = [{k: v.to(self.device, non_blocking=True) for k, v in t.items()}
+                       for t in targets]
+        self.batch = images, targets
+
+    def next(self):
+        """Return the batch moved to the device (or None if there are no batches left)
+        and start moving the next one.
+        """
+        batch = self.batch
+        if batch is None:
+            return None
+
+        if self.stream is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            # Prevent the memory of the batch from being reused by the copy stream
+            for img in batch[0]:
+                img.record_stream(current_stream)
+            for t in batch[1]:
+                for v in t.values():
+                    v.record_stream(current_stream)
+        self.preload()
+        return batch
+
+
+def get_trainable_parameters(model):
+    """Return a list of model parameters that require gradients.
+
+    The list is created once per model and reused (e.g. across hyperparameter
+    optimization trials), so parameters are expected not to be frozen
+    or unfrozen after the first call.
+    """
+    if model not in TRAINABLE_MODEL_PARAMETERS:
+        TRAINABLE_MODEL_PARAMETERS[model] = [p for p in model.parameters()
+                                             if p.requires_grad]
+    return TRAINABLE_MODEL_PARAMETERS[model]
+
+
+def build_optimizer(model, optimizer_name, optimizer_parameters=None):
+    """Return an optimizer from torch.optim for trainable model parameters."""
+    return getattr(torch.optim, optimizer_name)(get_trainable_parameters(model),
+                                                **(optimizer_parameters or {}))
+
+
+def build_lr_scheduler(optimizer, lr_scheduler_name=None, lr_scheduler_parameters=None):
+    """Return a learning rate scheduler from torch.optim.lr_scheduler
+    (or None if lr_scheduler_name is None).
+    """
+    if lr_scheduler_name is None:
+        return None
+    return getattr(torch.optim.lr_scheduler, lr_scheduler_name)(
+        optimizer, **(lr_scheduler_parameters or {}))
+
+
+def free_up_memory(device=torch.device('cpu')):  # noqa: B008
+    """Collect garbage and release cached CUDA memory if a CUDA device is used."""
+    gc.collect()
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+
+
+def images_to_float_tensors(images, device=torch.device('cpu')):  # noqa: B008
+    """Move image tensors to a device and convert them there to float tensors
+    with values in the range [0, 1] (uint8 images are rescaled, float ones are kept).
+    """
+    return [T.functional.convert_image_dtype(img.to(device, non_blocking=True), torch.float)
+            for img in images]
+
+
+def train_one_epoch(dataloader, model, optimizer, device=torch.device('cpu'),  # noqa: B008
+                    img_transforms=None, scaler=None, low_memory=False):
+    """Pass a training step in one epoch, applying image transformations
+    on the device if necessary.
+
+    If an enabled gradient scaler (torch.cuda.amp.GradScaler) is passed,
+    the step uses automatic mixed precision (CUDA only). If low_memory=True,
+    memory is freed up after each batch at the cost of speed.
+    """
+    if scaler is None:
+        scaler = torch.cuda.amp.GradScaler(enabled=False)
+
     accum_dict_losses = {}
     accum_model_loss = 0
     num_batches = len(dataloader)
@@ -99,13 +224,17 @@ def train_one_epoch(dataloader, model, optimizer, device=torch.device('cpu')):
     # Set a model in training mode
     model.train()
 
-    for images, targets in dataloader:
-        images = [img.to(device) for img in images]
-        targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+    for images, targets in CUDAPrefetcher(dataloader, device):
+        images = images_to_float_tensors(images, device)
+
+        if img_transforms is not None:
+            # Transform images one by one since their sizes may differ
+            images = [img_transforms(img.unsqueeze(0))[0] for img in images]
 
         # Compute model batch losses
-        batch_dict_losses = model(images, targets)
-        batch_model_loss = sum([loss for loss in batch_dict_losses.values()])
+        with torch.autocast('cuda', dtype=torch.float16, enabled=scaler.is_enabled()):
+            batch_dict_losses = model(images, targets)
+            batch_model_loss = sum([loss for loss in batch_dict_losses.values()])
 
         # Accumulate statistics for computing the average losses per epoch
         accum_dict_losses.update({
@@ -115,16 +244,16 @@ def train_one_epoch(dataloader, model, optimizer, device=torch.device('cpu')):
 
         # Optimize the model parameters
         optimizer.zero_grad()
-        batch_model_loss.backward()
-        optimizer.step()
+        scaler.scale(batch_model_loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
         # Free up memory
         del images
         del targets
-        gc.collect()
 
-        if str(device) == 'cuda':
-            torch.cuda.empty_cache()
+        if low_memory:
+            free_up_memory(device)
 
     # Compute the average losses
     epoch_dict_losses = {k: v / num_batches for k, v in accum_dict_losses.items()}
@@ -136,8 +265,10 @@ def train_one_epoch(dataloader, model, optimizer, device=torch.device('cpu')):
 
 @torch.inference_mode()
 def eval_one_epoch(dataloader, model, iou_thresh=0.5, beta=1,
-                   device=torch.device('cpu')):  # noqa: B008
-    """Pass an inference evaluation step in one epoch."""
+                   device=torch.device('cpu'), low_memory=False):  # noqa: B008
+    """Pass an inference evaluation step in one epoch (if low_memory=True,
+    memory is freed up after each batch at the cost of speed).
+    """
     accum_model_scores = {}
     results = []
     num_batches = len(dataloader)
@@ -145,9 +276,8 @@ def eval_one_epoch(dataloader, model, iou_thresh=0.5, beta=1,
     # Set a model in evaluation mode
     model.eval()
 
-    for images, targets in dataloader:
-        images = [img.to(device) for img in images]
-        targets = [{k: v.to(device) for k, v in t.items()} for t in targets]
+    for images, targets in CUDAPrefetcher(dataloader, device):
+        images = images_to_float_tensors(images, device)
 
         # Get prediction results
         outputs = model(images)
@@ -165,10 +295,9 @@ def eval_one_epoch(dataloader, model, iou_thresh=0.5, beta=1,
         # Free up memory
         del images
         del outputs
-        gc.collect()
 
-        if str(device) == 'cuda':
-            torch.cuda.empty_cache()
+        if low_memory:
+            free_up_memory(device)
 
     # Compute the average scores
     epoch_model_scores = {k: v / num_batches for k, v in accum_model_scores.items()}
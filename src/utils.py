@@ -1,5 +1,6 @@
 """This module contains helper functions for model training and inference."""
 
+import inspect
 import io
 import random
 from pathlib import Path
@@ -204,6 +205,17 @@ def get_random_img_with_info(csv_file_path, img_dir_path, license_pattern='',
         return None
 
 
+def load_model_state(filepath):
+    """Load a model state dictionary or a checkpoint saved by save_model_state
+    onto the CPU without unpickling arbitrary objects, memory-mapping the file
+    if the PyTorch version supports it.
+    """
+    load_params = {'map_location': 'cpu', 'weights_only': True}
+    if 'mmap' in inspect.signature(torch.load).parameters:
+        load_params['mmap'] = True
+    return torch.load(filepath, **load_params)
+
+
 def save_model_state(model_to_save, filepath, ckpt_params_dict=None):
     """Save a model state dictionary or a checkpoint."""
     Path(filepath).parent.mkdir(parents=True, exist_ok=True)
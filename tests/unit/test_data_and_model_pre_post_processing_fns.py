@@ -58,7 +58,10 @@ def test_update_registered_model_version_stages(model_registry):
     for _ in range(3):
         _ = client.create_model_version(reg_model_name, '', run_id=run_id, await_creation_for=5)
     client.transition_model_version_stage(reg_model_name, version='2', stage='Production')
-    _ = update_registered_model_version_stages(client, reg_model_name)
+    prod_run_id, prod_model_id = update_registered_model_version_stages(client,
+                                                                        reg_model_name)
+    assert prod_run_id == run_id
+    assert prod_model_id == f'models:/{reg_model_name}/3'
     assert client.get_model_version(reg_model_name, '2').current_stage == 'Archived'
     assert client.get_model_version(reg_model_name, '3').current_stage == 'Production'
     assert len(client.get_latest_versions(reg_model_name, stages=['Production'])) == 1
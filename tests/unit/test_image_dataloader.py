@@ -1,11 +1,37 @@
+import os
 import random
+import shutil
+from concurrent.futures import Future
 
 import albumentations as A
+import cv2
+import numpy as np
+import pandas as pd
+import pytest
 import torch
+from PIL import Image
 from torchvision.ops import box_convert
 
 # isort: off
-from src.data.image_dataloader import get_image_transforms, ImageBBoxDataset, create_dataloaders
+import src.data.image_dataloader as image_dataloader
+from src.data.image_dataloader import (get_image_transforms, ImageBBoxDataset,
+                                       create_dataloaders, SmartResize,
+                                       get_device_image_transforms, create_bbox_index,
+                                       BatchedImageBBoxDataset,
+                                       get_tmp_image_array_path,
+                                       log_failed_image_array_save, get_exif_orientation)
+
+
+def save_gradient_jpeg(save_path, orientation=None):
+    # A non-square image (width 40, height 20) so that rotation changes its shape
+    img = np.zeros((20, 40, 3), dtype=np.uint8)
+    img[..., 0] = np.arange(40) * 6
+    img[..., 1] = np.arange(20)[:, None] * 12
+    exif = Image.Exif()
+    if orientation is not None:
+        exif[0x0112] = orientation
+    Image.fromarray(img).save(save_path, exif=exif.tobytes(), quality=95)
+    return save_path
 
 
 def test_get_image_transforms():
@@ -13,12 +39,46 @@ def test_get_image_transforms():
     assert isinstance(img_transform, A.Compose)
 
 
+def test_get_device_image_transforms():
+    img_transform = get_device_image_transforms()
+    imgs = torch.rand(2, 3, 20, 30)
+    assert img_transform(imgs).size() == imgs.size()
+
+
+def test_smart_resize():
+    resize = A.Compose([SmartResize(800, 1333)],
+                       A.BboxParams(format='coco', label_fields=['labels']))
+    res = resize(image=np.zeros((267, 400, 3), dtype=np.uint8), bboxes=[[10, 20, 100, 50]],
+                 labels=[1])
+    assert res['image'].shape == (800, 1199, 3)
+    assert np.allclose(res['bboxes'][0], [30, 60, 300, 150], atol=1)
+    res = resize(image=np.zeros((200, 1000, 3), dtype=np.uint8), bboxes=[], labels=[])
+    assert res['image'].shape == (267, 1333, 3)
+
+
+def test_log_failed_image_array_save(tmp_path, caplog):
+    save_path = str(tmp_path / 'img.npy')
+    open(get_tmp_image_array_path(save_path), 'wb').close()
+    future = Future()
+    future.set_exception(OSError('No space left on device'))
+    log_failed_image_array_save(save_path, future)
+    assert 'No space left on device' in caplog.text
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize('orientation, expected', [(None, 1), (6, 6)])
+def test_get_exif_orientation(tmp_path, orientation, expected):
+    img_path = save_gradient_jpeg(tmp_path / 'img.jpg', orientation)
+    assert get_exif_orientation(img_path.read_bytes()) == expected
+
+
 class TestImageBBoxDataset:
 
     def test_imagebboxdataset_is_indexed(self, train_csv_path, imgs_path, bbox_path):
         idx = random.randint(0, 2)  # nosec
         ds = ImageBBoxDataset(train_csv_path, imgs_path, bbox_path)
         assert torch.is_tensor(ds[idx][0])
+        assert ds[idx][0].dtype == torch.uint8
         assert torch.is_tensor(ds[idx][1]['boxes'])
         assert torch.is_tensor(ds[idx][1]['labels'])
 
@@ -39,6 +99,77 @@ class TestImageBBoxDataset:
         assert ds[idx][1]['boxes'].size() == dstr[idx][1]['boxes'].size()
         assert [x1, y1, x2, y2] == [xx, yy, xx + w, yy + h]
 
+    def test_imagebboxdataset_bbox_index(self, train_csv_path, imgs_path, bbox_path, bbox_df):
+        ds = ImageBBoxDataset(train_csv_path, imgs_path, bbox_path)
+        for idx, img_name in enumerate(ds.img_names):
+            img_bboxes = bbox_df.loc[bbox_df.image_name == img_name]
+            assert ds.bbox_index[img_name].shape == (img_bboxes.shape[0], 4)
+            assert ds[idx][1]['labels'].numel() == img_bboxes.shape[0]
+
+    def test_imagebboxdataset_with_cache_dir(self, train_csv_path, imgs_path, bbox_path,
+                                             tmp_path):
+        ds = ImageBBoxDataset(train_csv_path, imgs_path, bbox_path, cache_dir=tmp_path)
+        decoded_imgs = [ds[idx][0] for idx in range(len(ds))]
+        ds.cache_executor.shutdown(wait=True)
+        assert sorted(p.name for p in tmp_path.iterdir()) == sorted(
+            os.path.basename(p) for p in ds.cache_paths)
+        assert all(torch.equal(ds[idx][0], img) for idx, img in enumerate(decoded_imgs))
+
+    def test_imagebboxdataset_with_cache_dir_and_overwritten_image(
+            self, train_csv_path, imgs_path, bbox_path, train_df, tmp_path):
+        tmp_imgs_path = tmp_path / 'imgs'
+        shutil.copytree(imgs_path, tmp_imgs_path)
+        ds = ImageBBoxDataset(train_csv_path, tmp_imgs_path, bbox_path,
+                              cache_dir=tmp_path / 'cache')
+        old_img = ds[0][0]
+        ds.cache_executor.shutdown(wait=True)
+        shutil.copyfile(tmp_imgs_path / train_df.Name.iloc[1],
+                        tmp_imgs_path / train_df.Name.iloc[0])
+        ds_new = ImageBBoxDataset(train_csv_path, tmp_imgs_path, bbox_path,
+                                  cache_dir=tmp_path / 'cache')
+        new_img = ImageBBoxDataset(train_csv_path, tmp_imgs_path, bbox_path)[0][0]
+        assert not torch.equal(ds_new[0][0], old_img)
+        assert torch.equal(ds_new[0][0], new_img)
+
+    def test_imagebboxdataset_with_exif_rotated_jpeg(self, tmp_path):
+        save_gradient_jpeg(tmp_path / 'rotated.jpg', orientation=6)
+        ds = ImageBBoxDataset(None, tmp_path, None,
+                              img_df=pd.DataFrame({'Name': ['rotated.jpg']}), bbox_index={})
+        assert ds.read_image(0).shape == (40, 20, 3)
+
+    @pytest.mark.skipif(image_dataloader.JPEG_DECODER is None,
+                        reason="PyTurboJPEG is not installed")
+    @pytest.mark.parametrize('orientation', [None, 6])
+    def test_imagebboxdataset_jpeg_decoders_return_same_image(self, tmp_path, orientation):
+        img_path = save_gradient_jpeg(tmp_path / 'img.jpg', orientation)
+        ds = ImageBBoxDataset(None, tmp_path, None, img_df=pd.DataFrame({'Name': ['img.jpg']}),
+                              bbox_index={})
+        opencv_img = cv2.cvtColor(cv2.imread(str(img_path), cv2.IMREAD_COLOR),
+                                  cv2.COLOR_BGR2RGB)
+        img = ds.read_image(0)
+        assert img.shape == opencv_img.shape
+        assert np.allclose(img, opencv_img, atol=2)
+
+    def test_imagebboxdataset_with_loaded_data(self, train_csv_path, imgs_path, bbox_path,
+                                               train_df, bbox_df):
+        ds = ImageBBoxDataset(train_csv_path, imgs_path, bbox_path)
+        ds_loaded = ImageBBoxDataset(None, imgs_path, None, img_df=train_df,
+                                     bbox_index=create_bbox_index(bbox_df))
+        assert len(ds) == len(ds_loaded)
+        assert all(torch.equal(ds[idx][1]['boxes'], ds_loaded[idx][1]['boxes'])
+                   for idx in range(len(ds)))
+
+
+def test_batchedimagebboxdataset_with_img_transform(train_csv_path, imgs_path, bbox_path):
+    ds = BatchedImageBBoxDataset(train_csv_path, imgs_path, bbox_path,
+                                 img_transforms=get_image_transforms('coco'))
+    samples = ds[[0, 1, 2]]
+    assert len(samples) == 3
+    assert all(torch.is_tensor(img) and torch.is_tensor(target['boxes'])
+               for img, target in samples)
+    assert all(min(img.shape[1:]) == 800 or max(img.shape[1:]) == 1333
+               for img, _ in samples)
+
 
 class TestCreateDataloaders:
 
@@ -52,3 +183,19 @@ class TestCreateDataloaders:
                                       train_test_split_data=True)
         assert len(dl1) == 2 and len(dl2) == 2
         assert len(dl1.dataset) == 3 and len(dl2.dataset) == 3
+
+    def test_create_dataloaders_with_workers(self, imgs_path, train_val_csv_path, bbox_path):
+        dl1, dl2 = create_dataloaders(imgs_path, train_val_csv_path, bbox_path, 2,
+                                      train_test_split_data=True, num_workers=2,
+                                      persistent_workers=True, prefetch_factor=4)
+        assert dl1.num_workers == dl2.num_workers == min(2, os.cpu_count())
+        assert len(next(iter(dl1))[0]) == 2
+
+    def test_create_dataloaders_with_same_transforms_per_batch(self, imgs_path,
+                                                               train_val_csv_path, bbox_path):
+        dl1, dl2 = create_dataloaders(imgs_path, train_val_csv_path, bbox_path, 2,
+                                      train_test_split_data=True, transform_train_imgs=True,
+                                      same_transforms_per_batch=True)
+        assert isinstance(dl1.dataset, BatchedImageBBoxDataset)
+        assert len(dl1) == 2 and len(dl2) == 2
+        assert sum(len(images) for images, _ in dl1) == 3
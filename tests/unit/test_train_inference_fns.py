@@ -5,7 +5,9 @@ import torch
 # isort: off
 from src.train.train_inference_fns import (object_detection_precision_recall_fbeta_scores,
                                            train_one_epoch, eval_one_epoch, predict,
-                                           predict_image)
+                                           predict_image, images_to_float_tensors,
+                                           CUDAPrefetcher, get_trainable_parameters,
+                                           build_optimizer, build_lr_scheduler)
 from src.train.fine_tune_model import run_train
 
 
@@ -20,6 +22,33 @@ def test_object_detection_precision_recall_fbeta_scores():
     assert round(res['f_beta'], 2) == 0.67
 
 
+def test_images_to_float_tensors():
+    images = [torch.full((3, 4, 5), 255, dtype=torch.uint8), torch.rand(3, 5, 4)]
+    res = images_to_float_tensors(images)
+    assert all(img.dtype == torch.float for img in res)
+    assert torch.equal(res[0], torch.ones(3, 4, 5))
+    assert torch.equal(res[1], images[1])
+
+
+def test_build_optimizer_and_lr_scheduler(frcnn_model):
+    optimizer = build_optimizer(frcnn_model, 'SGD', {'lr': 0.001})
+    lr_scheduler = build_lr_scheduler(optimizer, 'StepLR', {'step_size': 2})
+    trainable_params = get_trainable_parameters(frcnn_model)
+    assert trainable_params is get_trainable_parameters(frcnn_model)
+    assert all(p.requires_grad for p in trainable_params)
+    assert optimizer.param_groups[0]['params'] == trainable_params
+    assert isinstance(lr_scheduler, torch.optim.lr_scheduler.StepLR)
+    assert build_lr_scheduler(optimizer) is None
+
+
+def test_cuda_prefetcher(dataloader):
+    prefetcher = CUDAPrefetcher(dataloader)
+    batches = list(prefetcher)
+    assert len(batches) == len(prefetcher) == len(dataloader)
+    assert sum(len(images) for images, _ in batches) == len(dataloader.dataset)
+    assert all(len(images) == len(targets) for images, targets in batches)
+
+
 @pytest.mark.slow
 def test_train_one_epoch(dataloader, frcnn_model):
     frcnn_model.train()
@@ -9,7 +9,8 @@ from src.utils import (collate_batch, draw_and_save_seaborn_plot, draw_bboxes_on
                        get_current_stage_of_registered_model_version, get_device,
                        get_latest_registered_pytorch_model, get_number_of_csv_rows,
                        get_param_config_yaml, get_random_img_with_info,
-                       save_model_state, stratified_group_train_test_split)
+                       load_model_state, save_model_state,
+                       stratified_group_train_test_split)
 
 
 def test_collate_batch():
@@ -124,6 +125,14 @@ def test_save_model_state(frcnn_model, tmp_path):
     assert sum(compared_tensors) == len(current_mst)
 
 
+def test_load_model_state(frcnn_model, tmp_path):
+    save_model_state(frcnn_model, tmp_path / 'model_ckpt.pt', {'epoch': 2})
+    loaded_ckpt = load_model_state(tmp_path / 'model_ckpt.pt')
+    assert loaded_ckpt['epoch'] == 2
+    assert all(v.device.type == 'cpu' for v in loaded_ckpt['model_state_dict'].values())
+    assert loaded_ckpt['model_state_dict'].keys() == frcnn_model.state_dict().keys()
+
+
 class TestStratifiedGroupTrainTestSplit:
 
     def test_stratified_group_train_test_split_is_stratified(self, img_info_df):